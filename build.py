@@ -4,17 +4,51 @@ Distilled from github.com/jurialmunkey/repository.jurialmunkey/_repo_generator.p
 """
 
 import argparse
+import bisect
+import fnmatch
+import functools
 import hashlib
+import json
 import os
+import re
 import shutil
 import subprocess
 import sys
+import time
 import zipfile
 import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
+try:
+    # SIMD-accelerated drop-in for zlib, used by zipfile for DEFLATE
+    from zlib_ng import zlib_ng
+
+    zipfile.zlib = zlib_ng
+except ImportError:
+    pass
+
 # Constants
 KODI_VERSIONS = ["omega", "piers", "repo"]
+# Per-release build cache, kept out of the published zips/ directory
+CACHE_DIR = ".buildcache"
+COPY_BUFSIZE = 1 << 20
+METADATA_POINTS = {"xbmc.addon.metadata", "kodi.addon.metadata"}
+COMPRESS_LEVEL = 6
+# Already-compressed formats gain nothing from DEFLATE, so they are stored
+STORED_SUFFIXES = {
+    ".jpg",
+    ".jpeg",
+    ".png",
+    ".gif",
+    ".zip",
+    ".gz",
+    ".xz",
+    ".mp3",
+    ".mp4",
+    ".webm",
+    ".mkv",
+}
 IGNORE_PATTERNS = [
     ".git",
     ".github",
@@ -28,97 +62,260 @@ IGNORE_PATTERNS = [
     "*.pyo",
 ]
 
+# All ignore patterns, literal names included, compiled once into one alternation
+_IGNORE_REGEX = re.compile("|".join(map(fnmatch.translate, IGNORE_PATTERNS)) or "(?!)")
+
+
+SIZE_UNITS = ("B", "KB", "MB", "GB", "TB")
+
 
 def sizeof_fmt(num):
-    for unit in ["B", "KB", "MB", "GB"]:
-        if abs(num) < 1024.0:
-            return f"{num:3.1f} {unit}"
-        num /= 1024.0
-    return f"{num:.1f} TB"
+    # Each unit is 2**10 of the last, so the bit length picks it directly
+    idx = min((max(abs(int(num)), 1).bit_length() - 1) // 10, len(SIZE_UNITS) - 1)
+    return f"{num / (1 << (idx * 10)):3.1f} {SIZE_UNITS[idx]}"
+
+
+@functools.lru_cache(maxsize=None)
+def _should_ignore(name):
+    """Check if a file or directory name matches ignore patterns."""
+    return _IGNORE_REGEX.match(name) is not None
+
+
+def _compress_type(name):
+    """Pick the zip compression method for a file name."""
+    if os.path.splitext(name)[1].lower() in STORED_SUFFIXES:
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+
+def _write_file(zf, file_path, arcname, st=None):
+    """Stream a file into the zip with a larger buffer than ZipFile.write uses.
+
+    st can be a stat result already taken for file_path, saving another stat.
+    """
+    if st is None:
+        st = os.stat(file_path)
+    zinfo = zipfile.ZipInfo(arcname, time.localtime(st.st_mtime)[:6])
+    zinfo.file_size = st.st_size
+    zinfo.external_attr = (st.st_mode & 0xFFFF) << 16
+    zinfo.compress_type = _compress_type(arcname)
+    if hasattr(zinfo, "compress_level"):
+        zinfo.compress_level = zf.compresslevel
+    else:
+        # Before Python 3.13 the level is only settable through this private
+        # attribute, which is what ZipFile.write itself uses
+        zinfo._compresslevel = zf.compresslevel
+    with open(file_path, "rb", buffering=0) as src, zf.open(zinfo, "w") as dest:
+        shutil.copyfileobj(src, dest, COPY_BUFSIZE)
+
+
+def _link_or_copy(src, dest):
+    """Hardlink src to dest, falling back to a copy (e.g. across filesystems).
+
+    Like _write_atomic, the new file is moved into place from a temporary name,
+    so dest is never missing if both linking and copying fail.
+    """
+    if dest.exists() and os.path.samefile(src, dest):
+        return
+    tmp_path = dest.with_name(dest.name + ".tmp")
+    tmp_path.unlink(missing_ok=True)
+    try:
+        try:
+            os.link(src, tmp_path)
+        except OSError:
+            shutil.copyfile(src, tmp_path)
+        os.replace(tmp_path, dest)
+    except OSError:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+
+def _write_atomic(path, data):
+    """Write bytes via a temporary file so readers never see a partial file."""
+    tmp_path = path.with_name(path.name + ".tmp")
+    tmp_path.write_bytes(data)
+    os.replace(tmp_path, path)
+
+
+def _iter_asset_names(addon_root):
+    """Yield addon.xml plus the asset paths declared in the metadata extension."""
+    yield "addon.xml"
+    for ext in addon_root.iterfind("extension"):
+        if ext.get("point") in METADATA_POINTS:
+            for asset in ext.iterfind("assets/*"):
+                if asset.text:
+                    yield asset.text
+
+
+def _addon_id_key(addon_id):
+    return addon_id or ""
+
+
+def _load_addons_xml(path):
+    """Incrementally parse addons.xml, returning its tree and an id -> addon map."""
+    addons = {}
+    context = ET.iterparse(path, events=("end",))
+    for _, elem in context:
+        if elem.tag == "addon":
+            addons[elem.get("id")] = elem
+    return ET.ElementTree(context.root), addons
+
+
+def _scandir_recursive(path, prune=None):
+    """Yield (entry, is_dir) below path, not descending into pruned dirs."""
+    with os.scandir(path) as it:
+        for entry in it:
+            is_dir = entry.is_dir(follow_symlinks=False)
+            yield entry, is_dir
+            if is_dir and not (prune and prune(entry)):
+                yield from _scandir_recursive(entry.path, prune)
+
+
+def _is_ignored_dir(entry):
+    # Any ignored name prunes its whole subtree, so nothing below it is matched
+    return _should_ignore(entry.name)
+
+
+def _walk_files(root, mtimes=None):
+    """Yield (path, arcname, stat) for files to zip, skipping ignored subtrees.
+
+    If mtimes is a list, the mtime (ns) of every entry walked is appended to it.
+    Directories are included so that deleted files are noticed too.
+    """
+    root = os.fspath(root)
+    prefix = os.path.basename(root)
+    start = len(root) + 1
+    for entry, is_dir in _scandir_recursive(root, prune=_is_ignored_dir):
+        if _should_ignore(entry.name):
+            continue
+        if mtimes is not None:
+            mtimes.append(entry.stat(follow_symlinks=False).st_mtime_ns)
+        if is_dir or not entry.is_file():
+            continue
+        yield entry.path, f"{prefix}/{entry.path[start:]}", entry.stat()
+
+
+def _tree_mtime(root):
+    """Latest mtime (ns) of the addon directory or anything that would be zipped."""
+    mtimes = [os.stat(root).st_mtime_ns]
+    for _ in _walk_files(root, mtimes):
+        pass
+    return max(mtimes)
+
+
+def _build_zip(
+    addon_path, zip_file, force=False, compresslevel=COMPRESS_LEVEL, cache_file=None
+):
+    """Zip an addon directory. Returns the zip size, or None if it was skipped.
+
+    An existing zip is kept unless forced. With a cache_file, it is also rebuilt
+    when the addon tree or compression level differs from the cached build.
+    Module-level so it can be run in a worker process.
+    """
+    if zip_file.exists() and not force:
+        if cache_file is None:
+            return None
+        try:
+            cached = json.loads(cache_file.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            cached = None
+        current = {"mtime_ns": _tree_mtime(addon_path), "compresslevel": compresslevel}
+        if cached == current:
+            return None
+
+    mtimes = None if cache_file is None else [os.stat(addon_path).st_mtime_ns]
+    with zipfile.ZipFile(
+        zip_file, "w", zipfile.ZIP_DEFLATED, compresslevel=compresslevel
+    ) as zf:
+        for file_path, archive_name, st in _walk_files(addon_path, mtimes):
+            _write_file(zf, file_path, archive_name, st)
+
+    if cache_file is not None:
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        cache = {"mtime_ns": max(mtimes), "compresslevel": compresslevel}
+        cache_file.write_text(json.dumps(cache), encoding="utf-8")
+    return zip_file.stat().st_size
 
 
 class Generator:
-    def __init__(self, release_dir, force=False):
+    def __init__(
+        self,
+        release_dir,
+        force=False,
+        compresslevel=COMPRESS_LEVEL,
+        rebuild_changed=False,
+    ):
         self.release_path = Path(release_dir)
         self.force = force
+        self.compresslevel = compresslevel
+        self.rebuild_changed = rebuild_changed
         self.zips_path = self.release_path / "zips"
         self.zips_path.mkdir(parents=True, exist_ok=True)
 
         self._clean_binaries()
-        if self._generate_addons_xml():
-            self._generate_md5()
+        self._generate_addons_xml()
 
     def _clean_binaries(self):
         """Removes compiled python files and caches."""
-        for p in self.release_path.rglob("*"):
-            if p.name == "__pycache__" and p.is_dir():
-                shutil.rmtree(p)
-                print(f"Removed cache: {p}")
-            elif p.suffix in {".pyc", ".pyo"} and p.is_file():
-                p.unlink()
-                print(f"Removed binary: {p}")
-
-    def _should_ignore(self, path):
-        """Check if path matches ignore patterns."""
-        return any(
-            pattern in path.parts or path.match(pattern) for pattern in IGNORE_PATTERNS
-        )
-
-    def _create_zip(self, addon_path, addon_id, version):
-        zip_dir = self.zips_path / addon_id
-        zip_dir.mkdir(exist_ok=True)
-        zip_file = zip_dir / f"{addon_id}-{version}.zip"
-
-        if zip_file.exists() and not self.force:
-            print(f"Skipping existing: {addon_id} {version}")
-            return
-
-        with zipfile.ZipFile(zip_file, "w", zipfile.ZIP_DEFLATED) as zf:
-            for file_path in addon_path.rglob("*"):
-                if file_path.is_file() and not self._should_ignore(file_path):
-                    archive_name = file_path.relative_to(addon_path.parent)
-                    zf.write(file_path, archive_name)
-
-        print(
-            f"Created zip: {addon_id} {version} - {sizeof_fmt(zip_file.stat().st_size)}"
-        )
+        for entry, is_dir in _scandir_recursive(
+            self.release_path, prune=lambda e: e.name == "__pycache__"
+        ):
+            if is_dir:
+                if entry.name == "__pycache__":
+                    shutil.rmtree(entry.path)
+                    print(f"Removed cache: {entry.path}")
+            elif entry.name.endswith((".pyc", ".pyo")) and entry.is_file(
+                follow_symlinks=False
+            ):
+                os.unlink(entry.path)
+                print(f"Removed binary: {entry.path}")
 
     def _copy_assets(self, addon_path, addon_xml_root):
         """Copy assets defined in addon.xml to the zips directory."""
-        addon_id = addon_xml_root.get("id")
-        assets = []
-
-        # Standard assets
-        assets.append("addon.xml")
-
-        # Parse assets from extension points
-        for ext in addon_xml_root.findall("extension"):
-            if ext.get("point") in ["xbmc.addon.metadata", "kodi.addon.metadata"]:
-                assets_node = ext.find("assets")
-                if assets_node is not None:
-                    assets.extend(asset.text for asset in assets_node if asset.text)
-
-        dest_dir = self.zips_path / addon_id
-        for asset in assets:
-            src = addon_path / asset
-            if src.exists():
+        dest_dir = self.zips_path / addon_xml_root.get("id")
+
+        # List each asset directory once rather than stat-ing every asset
+        listings = {}
+        for asset in _iter_asset_names(addon_xml_root):
+            parent, name = os.path.split(asset)
+            if parent not in listings:
+                try:
+                    with os.scandir(addon_path / parent) as it:
+                        listings[parent] = {entry.name for entry in it}
+                except OSError:
+                    listings[parent] = set()
+
+            if name in listings[parent]:
                 dest = dest_dir / asset
                 dest.parent.mkdir(parents=True, exist_ok=True)
-                shutil.copy(src, dest)
+                if asset == "addon.xml":
+                    shutil.copyfile(addon_path / asset, dest)
+                else:
+                    _link_or_copy(addon_path / asset, dest)
+
+    def _cache_file(self, zip_file):
+        """Build cache entry for a zip, or None when changed zips aren't rebuilt."""
+        if not self.rebuild_changed:
+            return None
+        return self.release_path / CACHE_DIR / f"{zip_file.stem}.json"
 
     def _generate_addons_xml(self):
         addons_xml_path = self.zips_path / "addons.xml"
 
         # Load existing or create new
         if addons_xml_path.exists():
-            tree = ET.parse(addons_xml_path)
+            tree, existing_map = _load_addons_xml(addons_xml_path)
             root = tree.getroot()
         else:
             root = ET.Element("addons")
-            tree = ET.ElementTree(root)
+            existing_map = {}
+
+        # addons.xml is written sorted, so this is a single pass over the ids
+        addon_ids = sorted(existing_map, key=_addon_id_key)
 
         changed = False
         found_ids = set()
+        pending = []
 
         # Process all addons in release folder
         for addon_dir in [
@@ -138,63 +335,173 @@ class Generator:
                 found_ids.add(addon_id)
 
                 # Find existing entry
-                existing = root.find(f"./addon[@id='{addon_id}']")
+                existing = existing_map.get(addon_id)
 
                 if (
                     existing is not None
                     and existing.get("version") == version
                     and not self.force
+                    and not self.rebuild_changed
                 ):
                     continue
 
-                # Update or Add
-                if existing is not None:
-                    root.remove(existing)
+                zip_dir = self.zips_path / addon_id
+                zip_dir.mkdir(exist_ok=True)
+                zip_file = zip_dir / f"{addon_id}-{version}.zip"
+                pending.append((addon_dir, addon_root, zip_file))
 
-                root.append(addon_root)
-                self._create_zip(addon_dir, addon_id, version)
+            except Exception as e:
+                print(f"Error processing {addon_dir.name}: {e}")
+
+        jobs = [
+            functools.partial(
+                _build_zip,
+                addon_dir,
+                zip_file,
+                self.force,
+                self.compresslevel,
+                self._cache_file(zip_file),
+            )
+            for addon_dir, _, zip_file in pending
+        ]
+
+        # Zips are independent of each other, so several are built in parallel
+        if len(jobs) > 1:
+            workers = min(len(jobs), os.cpu_count() or 1)
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(job) for job in jobs]
+            jobs = [future.result for future in futures]
+
+        for (addon_dir, addon_root, zip_file), job in zip(pending, jobs):
+            addon_id = addon_root.get("id")
+            version = addon_root.get("version")
+            try:
+                size = job()
+                existing = existing_map.get(addon_id)
+                if (
+                    size is None
+                    and existing is not None
+                    and existing.get("version") == version
+                ):
+                    # Only checked for changes, and there were none
+                    continue
+                if size is None:
+                    print(f"Skipping existing: {addon_id} {version}")
+                else:
+                    print(f"Created zip: {addon_id} {version} - {sizeof_fmt(size)}")
+
+                # Update or Add, keeping addon_ids sorted
+                if addon_id not in existing_map:
+                    bisect.insort(addon_ids, addon_id, key=_addon_id_key)
+                existing_map[addon_id] = addon_root
                 self._copy_assets(addon_dir, addon_root)
                 changed = True
 
             except Exception as e:
                 print(f"Error processing {addon_dir.name}: {e}")
 
+        md5_path = self.zips_path / "addons.xml.md5"
+        old_data = addons_xml_path.read_bytes() if addons_xml_path.exists() else None
+        data = old_data
         if changed:
-            # Sort addons by ID
-            root[:] = sorted(root, key=lambda child: child.get("id") or "")
-            tree.write(addons_xml_path, encoding="utf-8", xml_declaration=True)
+            # Addons in ID order
+            root[:] = [existing_map[k] for k in addon_ids]
+            data = ET.tostring(root, encoding="utf-8", xml_declaration=True)
+
+        # Only rewrite files whose content differs, leaving mtimes alone otherwise
+        updated = False
+        if data is not None and data != old_data:
+            _write_atomic(addons_xml_path, data)
             print(f"Updated {addons_xml_path}")
-            return True
-        else:
+            updated = True
+
+        if data is not None:
+            # Hash the serialized bytes directly rather than re-reading the file
+            md5_hash = hashlib.md5(data).hexdigest()
+            if not (
+                md5_path.exists() and md5_path.read_text(encoding="utf-8") == md5_hash
+            ):
+                _write_atomic(md5_path, md5_hash.encode("utf-8"))
+                print(f"Updated {md5_path}")
+                updated = True
+
+        if not updated:
             print(f"No changes for {self.release_path}")
-            return False
+        return updated
 
-    def _generate_md5(self):
-        xml_path = self.zips_path / "addons.xml"
-        md5_path = self.zips_path / "addons.xml.md5"
 
-        md5_hash = hashlib.md5(xml_path.read_bytes()).hexdigest()
-        md5_path.write_text(md5_hash, encoding="utf-8")
-        print(f"Updated {md5_path}")
+def build_releases(
+    releases, force=False, compresslevel=COMPRESS_LEVEL, rebuild_changed=False
+):
+    """Run the Generator for each release directory.
+
+    Releases share no state, so several are built in parallel processes.
+    """
+    generate = functools.partial(
+        Generator,
+        force=force,
+        compresslevel=compresslevel,
+        rebuild_changed=rebuild_changed,
+    )
+    if len(releases) <= 1:
+        for release in releases:
+            generate(release)
+        return
+
+    workers = min(len(releases), os.cpu_count() or 1)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(generate, releases))
 
 
 def update_submodules():
-    """Update all git submodules."""
+    """Start updating all git submodules in the background.
+
+    Returns the running process, or None if git is unavailable.
+    """
     try:
         print("Updating git submodules...")
-        subprocess.check_call(
+        return subprocess.Popen(
             ["git", "submodule", "update", "--init", "--recursive", "--remote"],
             stdout=sys.stdout,
             stderr=sys.stderr,
         )
-        print("Git submodules updated.")
-    except subprocess.CalledProcessError as e:
-        print(f"Failed to update git submodules: {e}")
     except FileNotFoundError:
         print("git command not found. Skipping submodule update.")
+        return None
+
+
+def wait_for_submodules(process):
+    """Wait for a submodule update started by update_submodules."""
+    if process is None:
+        return
+    returncode = process.wait()
+    if returncode:
+        e = subprocess.CalledProcessError(returncode, process.args)
+        print(f"Failed to update git submodules: {e}")
+    else:
+        print("Git submodules updated.")
+
 
+def _submodule_paths():
+    """Resolved paths of the submodules declared in .gitmodules."""
+    try:
+        text = Path(".gitmodules").read_text(encoding="utf-8")
+    except OSError:
+        return []
+    return [
+        Path(p).resolve() for p in re.findall(r"^\s*path\s*=\s*(.+?)\s*$", text, re.M)
+    ]
+
+
+def _uses_submodules(release, submodules):
+    release = Path(release).resolve()
+    return any(
+        release == sm or release in sm.parents or sm in release.parents
+        for sm in submodules
+    )
 
-def create_repo_zip():
+
+def create_repo_zip(compresslevel=COMPRESS_LEVEL):
     """Create the repository zip file."""
     root_path = Path(".")
     xml_file = root_path / "addon.xml"
@@ -214,12 +521,14 @@ def create_repo_zip():
 
         print(f"Creating repo zip: {zip_name}")
 
-        with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as zf:
+        with zipfile.ZipFile(
+            zip_path, "w", zipfile.ZIP_DEFLATED, compresslevel=compresslevel
+        ) as zf:
             files_to_zip = ["addon.xml", "icon.jpg", "fanart.jpg"]
             for file_name in files_to_zip:
                 file_path = root_path / file_name
                 if file_path.exists():
-                    zf.write(file_path, f"{addon_id}/{file_name}")
+                    _write_file(zf, file_path, f"{addon_id}/{file_name}")
                 else:
                     print(f"Warning: {file_name} not found, skipping.")
 
@@ -240,24 +549,57 @@ def main():
     parser.add_argument(
         "releases", nargs="*", default=KODI_VERSIONS, help="Release directories"
     )
-    parser.add_argument("--force", action="store_true", help="Force rebuild")
+    parser.add_argument(
+        "--force", action="store_true", help="Force rebuild of every addon zip"
+    )
+    parser.add_argument(
+        "--rebuild-changed",
+        action="store_true",
+        help="Also rebuild existing zips whose addon files changed since last build",
+    )
+    parser.add_argument(
+        "--level",
+        type=int,
+        choices=range(10),
+        default=COMPRESS_LEVEL,
+        help="DEFLATE compression level (lower is faster)",
+    )
     args = parser.parse_args()
 
-    # Update submodules before checking for directories
-    update_submodules()
+    # Update submodules in the background while building what doesn't need them
+    process = update_submodules()
 
     # Create the repository zip
-    create_repo_zip()
+    create_repo_zip(compresslevel=args.level)
+
+    # Releases without submodules can be built while the update runs
+    submodules = _submodule_paths()
+    independent = [
+        d
+        for d in args.releases
+        if os.path.isdir(d) and not _uses_submodules(d, submodules)
+    ]
+    build_releases(
+        independent,
+        force=args.force,
+        compresslevel=args.level,
+        rebuild_changed=args.rebuild_changed,
+    )
 
-    # Filter valid directories
-    dirs = [d for d in args.releases if os.path.isdir(d)]
+    # Filter valid directories once submodules are checked out
+    wait_for_submodules(process)
+    dirs = [d for d in args.releases if d not in independent and os.path.isdir(d)]
 
-    if not dirs:
+    if not dirs and not independent:
         print("No valid release directories found.")
         return
 
-    for release in dirs:
-        Generator(release, force=args.force)
+    build_releases(
+        dirs,
+        force=args.force,
+        compresslevel=args.level,
+        rebuild_changed=args.rebuild_changed,
+    )
 
 
 if __name__ == "__main__":